@@ -3,13 +3,16 @@
 """
 generate_quiz_video_pro_short.py
 Creates a polished 9:16 quiz video with 5 AI-generated questions.
-- MoviePy animations when available (recommended)
-- TTS per question (Piper preferred, else espeak-ng)
+- Single ffmpeg filter graph render (MoviePy as fallback)
+- TTS per question (Piper preferred, in-process via piper-tts if installed, else espeak-ng)
 - Question source priority: OpenAI API -> GPT4All -> internal fallback
 - Output: quiz_YYYYMMDD_HHMMSS.mp4 in CWD
 """
 from __future__ import annotations
-import os, sys, json, random, shutil, subprocess
+import os, sys, json, random, hashlib, shutil, subprocess, tempfile, threading, wave, atexit
+import ctypes, ctypes.util
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime
 from typing import List, Dict, Optional
 
@@ -19,6 +22,8 @@ try:
         ColorClip, ImageClip, TextClip, CompositeVideoClip,
         concatenate_videoclips, AudioFileClip, CompositeAudioClip
     )
+    from moviepy.audio.AudioClip import AudioArrayClip
+    import numpy as np
     MOVIEPY = True
 except Exception:
     MOVIEPY = False
@@ -39,6 +44,13 @@ if USE_OPENAI:
     except Exception:
         USE_OPENAI = False
 
+# Optional Piper python package (in-process TTS, model stays loaded)
+try:
+    from piper import PiperVoice
+    PIPER_PY = True
+except Exception:
+    PIPER_PY = False
+
 # Optional GPT4All (local)
 try:
     from gpt4all import GPT4All
@@ -52,7 +64,26 @@ FPS = 30
 FONT = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
 BG_UP = "/mnt/data/A_2D_digital_graphic_quiz_image_features_a_dark_bl.png"
 BG_GEN = "bg_quiz.png"
+GPT4ALL_MODEL = "models/ggml-gpt4all-j.bin"
 MUSIC = "music/track1.mp3"
+# persistent cache for artifacts that only depend on their inputs (restored in CI)
+CACHE_DIR = os.environ.get("QUIZ_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "quiz-video")
+CACHE_MAX = 500  # entries kept per kind (bg, questions, tts), least recently used go first
+# H.264 encoders in order of preference; extra args go right after -c:v
+VCODEC_ARGS = {
+    "h264_nvenc": ["-preset","p1","-tune","ll","-rc","vbr","-cq","23"],
+    "h264_amf": ["-usage","transcoding","-quality","speed","-rc","cqp","-qp_i","23","-qp_p","25"],
+    "h264_qsv": [],
+    "h264_vaapi": ["-qp","23"],
+    "h264_videotoolbox": [],
+    # every segment is a still frame: no point in scene-cut detection or motion tuning
+    "libx264": ["-preset","veryfast","-tune","stillimage","-threads","0","-x264-params","scenecut=0:rc-lookahead=10:sync-lookahead=0"],
+}
+# encoders fed with GPU frames: global device args + the filter that uploads to it
+VAAPI_DEVICE = os.environ.get("VAAPI_DEVICE", "/dev/dri/renderD128")
+VCODEC_HW = {"h264_vaapi": (["-vaapi_device", VAAPI_DEVICE], "format=nv12,hwupload")}
+# single-frame image inputs need no stream probing
+FFPROBE_FAST = ["-probesize","32","-analyzeduration","0","-fpsprobesize","0","-avioflags","direct"]
 PIPER_CANDS = ["./piper/piper","./piper","piper"]
 PIPER_MODEL_DIRS = ["./piper_models/de_DE-eva_k-x_low", "./piper_models"]
 
@@ -63,38 +94,157 @@ QUESTION_VIS = 1.8
 ANS_EASY = 2.5
 ANS_MED = 3.0
 ANS_HARD = 3.8
+ANS_BY_DIFFICULTY = {"easy": ANS_EASY, "medium": ANS_MED}  # hard/impossible/unknown -> ANS_HARD
 REVEAL_DUR = 1.5
 
 NUM_QUESTIONS = 5  # as requested (option A)
 
 # Helpers
-def log(*a, **k): print(*a, **k); sys.stdout.flush()
+_LOG_LOCK = threading.Lock()  # TTS workers log concurrently
+def log(*a, **k):
+    with _LOG_LOCK: print(*a, **k); sys.stdout.flush()
 def file_ok(p): return os.path.exists(p) and os.path.getsize(p)>0
-def sanitize(s): return "".join(ch for ch in s if ord(ch)>=32)
+_CTRL_TABLE = dict.fromkeys(range(32))  # control chars -> deleted
+def sanitize(s): return s.translate(_CTRL_TABLE)
+# per-run scratch dir for intermediates (bg, voices); removed in one go at exit
+_WORK = None
+_WORK_LOCK = threading.Lock()
+def work_path(name):
+    global _WORK
+    with _WORK_LOCK:
+        if _WORK is None:
+            _WORK = tempfile.mkdtemp(prefix="quiz_")
+            atexit.register(shutil.rmtree, _WORK, ignore_errors=True)
+    return os.path.join(_WORK, name)
+def cache_path(kind, key, ext):
+    d = os.path.join(CACHE_DIR, kind)
+    try: os.makedirs(d, exist_ok=True)
+    except OSError: return None
+    return os.path.join(d, hashlib.sha1(key.encode("utf-8")).hexdigest() + ext)
+def cache_get(p):
+    # a hit bumps the mtime, so cache_prune drops the least recently used entries
+    if not (p and file_ok(p)): return False
+    try: os.utime(p)
+    except OSError: pass
+    return True
+def cache_prune(d, keep=CACHE_MAX):
+    # the CI cache is re-saved every run: cap each kind instead of growing forever
+    try:
+        ents = sorted((e for e in os.scandir(d) if e.is_file() and not e.name.endswith(".tmp")), key=lambda e: e.stat().st_mtime, reverse=True)
+        for e in ents[keep:]: os.remove(e.path)
+    except OSError as e:
+        log("Cache prune failed:", e)
+def cache_store(src, dst):
+    if not dst: return
+    try:
+        shutil.copyfile(src, dst + ".tmp"); os.replace(dst + ".tmp", dst)
+    except OSError as e:
+        log("Cache write failed:", e)
+        return
+    cache_prune(os.path.dirname(dst))
+def run_quiet(cmd, what, input=None):
+    # stdout dropped, stderr spooled to a temp file and only decoded/logged on failure
+    with tempfile.TemporaryFile() as err:
+        cp = subprocess.run(cmd, input=input, stdout=subprocess.DEVNULL, stderr=err)
+        if cp.returncode != 0:
+            err.seek(0)
+            log(f"{what} failed:", err.read().decode("utf-8", "replace"))
+    return cp.returncode
+OPT_SEP = "   "  # gap between answer options; wrap_text only breaks lines there
+def format_options(opts): return OPT_SEP.join(f"{'ABCD'[i]}: {o}" for i,o in enumerate(opts[:4]))
+def ff_text(s):
+    # drawtext value inside -filter_complex: escape for the option parser, then the graph parser
+    s = s.replace("\\", "\\\\").replace("'", "\\'").replace(":", "\\:")
+    return "".join("\\"+c if c in "\\'[],;" else c for c in s)
+
+# Video encoder: first hardware encoder that survives a tiny test encode, else libx264
+_VCODEC = None
+def pick_vcodec():
+    global _VCODEC
+    if _VCODEC: return _VCODEC
+    _VCODEC = "libx264"
+    try:
+        cp = subprocess.run(["ffmpeg","-hide_banner","-encoders"], capture_output=True, text=True)
+        for c in VCODEC_ARGS:
+            if c=="libx264" or c not in cp.stdout: continue
+            # builds list hw encoders even without a device, so actually try one
+            dev, up = VCODEC_HW.get(c, ([], "format=yuv420p"))
+            t = subprocess.run(["ffmpeg","-hide_banner"]+dev+["-f","lavfi","-i","color=s=256x256:d=0.1","-vf",up,"-c:v",c]+VCODEC_ARGS[c]+["-f","null","-"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if t.returncode==0:
+                _VCODEC = c; break
+    except Exception as e:
+        log("Encoder probe failed:", e)
+    log("Video encoder:", _VCODEC)
+    return _VCODEC
+
+def vcodec_args():
+    c = pick_vcodec()
+    return ["-c:v", c] + VCODEC_ARGS[c] + ([] if c in VCODEC_HW else ["-pix_fmt","yuv420p"])
+def vcodec_device(): return VCODEC_HW.get(pick_vcodec(), ([], ""))[0]
+def vcodec_format(): return VCODEC_HW.get(pick_vcodec(), ([], "format=yuv420p"))[1]
 
 # Background generation (Pillow if available)
 def ensure_background():
+    out = work_path(BG_GEN)
     if os.path.isfile(BG_UP):
-        shutil.copyfile(BG_UP, BG_GEN)
+        shutil.copyfile(BG_UP, out)
+        return True
+    # the gradient only depends on the frame size; bump the key when its colors change
+    cached = cache_path("bg", f"gradient-v2|{WIDTH}x{HEIGHT}", ".png")
+    if cache_get(cached):
+        shutil.copyfile(cached, out)
         return True
     if PIL_OK:
         try:
-            img = Image.new("RGB", (WIDTH, HEIGHT), (12,12,20))
-            d = ImageDraw.Draw(img)
-            for y in range(HEIGHT):
-                t = y/HEIGHT
-                r = int(8 + 20*t); g = int(10 + 10*t); b = int(18 + 40*t)
-                d.line([(0,y),(WIDTH,y)], fill=(r,g,b))
-            img.save(BG_GEN, quality=92)
+            # vertical gradient: build one 1px column, then stretch it in C
+            col = Image.new("RGB", (1, HEIGHT))
+            col.putdata([(int(8 + 20*y/HEIGHT), int(10 + 10*y/HEIGHT), int(18 + 40*y/HEIGHT)) for y in range(HEIGHT)])
+            # the gradient has < 256 colors: an 8-bit palette PNG is lossless and a third
+            # of the size to write/read (ffmpeg converts to yuv420p in the same pass)
+            img = col.convert("P", palette=Image.ADAPTIVE).resize((WIDTH, HEIGHT), Image.NEAREST)
+            img.save(out, compress_level=1)  # PNG ignores quality=; fast deflate is plenty
+            cache_store(out, cached)
             return True
         except Exception as e:
             log("BG Pillow fail:", e)
     # fallback via ffmpeg color
-    subprocess.run(["ffmpeg","-y","-f","lavfi","-i",f"color=c=#0f0f1e:s={WIDTH}x{HEIGHT}:d=0.1","-frames:v","1",BG_GEN])
-    return file_ok(BG_GEN)
+    run_quiet(["ffmpeg","-y","-f","lavfi","-i",f"color=c=#0f0f1e:s={WIDTH}x{HEIGHT}:d=0.1","-frames:v","1",out], "BG ffmpeg")
+    return file_ok(out)
+
+# GPT4All model loaded at most once per run; None until first use, False if unavailable
+_GPT4ALL = None
+_GPT4ALL_LOCK = threading.Lock()
+def get_gpt4all():
+    global _GPT4ALL
+    with _GPT4ALL_LOCK:
+        if _GPT4ALL is None:
+            _GPT4ALL = False
+            if GPT4ALL_OK and os.path.isfile(GPT4ALL_MODEL):
+                try:
+                    # use every core for inference; older bindings don't take n_threads
+                    try: _GPT4ALL = GPT4All(GPT4ALL_MODEL, n_threads=os.cpu_count())
+                    except TypeError: _GPT4ALL = GPT4All(GPT4ALL_MODEL)
+                except Exception as e:
+                    log("GPT4All load failed:", e)
+        return _GPT4ALL
 
 # Question generation: OpenAI -> GPT4All -> fallback
+def store_questions(dst, arr):
+    src = work_path("questions.json")
+    with open(src, "w", encoding="utf-8") as f: json.dump(arr, f, ensure_ascii=False)
+    cache_store(src, dst)
+    return arr
+
 def generate_questions(topic="Allgemeinwissen", n=NUM_QUESTIONS):
+    # LLM answers are cached per day, so a rerun (e.g. after a failed upload) skips the
+    # API/model call without repeating yesterday's quiz; QUIZ_REFRESH=1 bypasses
+    cached = cache_path("questions", f"{topic}|{n}|{datetime.now():%Y-%m-%d}", ".json")
+    if os.environ.get("QUIZ_REFRESH") != "1" and cache_get(cached):
+        try:
+            with open(cached, encoding="utf-8") as f: arr = json.load(f)
+            if isinstance(arr, list) and len(arr)>=n: return arr[:n]
+        except (OSError, ValueError) as e:
+            log("Question cache unreadable:", e)
     # Prefer OpenAI API if available (more reliable quality)
     if USE_OPENAI:
         try:
@@ -113,31 +263,45 @@ Reihenfolge: von leicht zu schwer (steigend).
             txt = resp["choices"][0]["message"]["content"]
             arr = extract_json(txt)
             if arr and isinstance(arr, list) and len(arr)>=n:
-                return arr[:n]
+                return store_questions(cached, arr[:n])
         except Exception as e:
             log("OpenAI questions failed:", e)
     # Try GPT4All local
-    if GPT4ALL_OK and os.path.isfile("models/ggml-gpt4all-j.bin"):
+    model = get_gpt4all()
+    if model:
         try:
-            model = GPT4All("models/ggml-gpt4all-j.bin")
             prompt = f"Erzeuge {n} Fragen (Deutsch) in JSON... (kurz)"
-            out = model.generate(prompt, max_tokens=600)
-            arr = extract_json(out)
-            if arr and len(arr)>=n: return arr[:n]
+            # stop once the JSON array holds n questions instead of using up the token budget
+            pieces = []
+            def on_token(token_id, piece):
+                pieces.append(piece)
+                if "]" not in piece: return True
+                arr = extract_json("".join(pieces))
+                return not (arr and len(arr)>=n)
+            try: out = model.generate(prompt, max_tokens=500, callback=on_token)
+            except TypeError: out = model.generate(prompt, max_tokens=500)  # older bindings
+            arr = extract_json("".join(pieces) or out)
+            if arr and len(arr)>=n: return store_questions(cached, arr[:n])
         except Exception as e:
             log("GPT4All failed:", e)
     # Last fallback: templated mixed questions (good quality)
     return fallback_questions(n, topic)
 
+_JSON_DEC = json.JSONDecoder()
 def extract_json(text):
     if not text: return None
     s = text.strip()
-    if "[" in s and "]" in s:
-        s = s[s.find("["):s.rfind("]")+1]
-    try:
-        return json.loads(s)
-    except Exception:
-        return None
+    # decode forward from each '[' and take the first complete array of question objects;
+    # trailing prose, a bracketed preamble ("[Antwort]") or an inner options list don't match
+    i = s.find("[")
+    while i >= 0:
+        try:
+            obj, _ = _JSON_DEC.raw_decode(s, i)
+            if isinstance(obj, list) and obj and all(isinstance(x, dict) for x in obj): return obj
+        except ValueError:
+            pass
+        i = s.find("[", i+1)
+    return None
 
 def fallback_questions(n, topic):
     # build a small pool and pick n with increasing difficulty
@@ -177,30 +341,214 @@ def find_piper():
             return c
     return None
 
+def find_piper_model():
+    for d in PIPER_MODEL_DIRS:
+        if os.path.isdir(d):
+            for f in sorted(os.listdir(d)):
+                if f.endswith(".onnx"): return os.path.join(d, f)
+    return None
+
+# Piper voice loaded once per run; None until first use, False if unavailable
+_PIPER_VOICE = None
+_PIPER_LOCK = threading.Lock()
+def get_piper_voice():
+    global _PIPER_VOICE
+    with _PIPER_LOCK:
+        if _PIPER_VOICE is None:
+            _PIPER_VOICE = False
+            model = find_piper_model() if PIPER_PY else None
+            if model:
+                try:
+                    _PIPER_VOICE = PiperVoice.load(model, use_cuda=False)
+                except Exception as e:
+                    log("Piper voice load failed:", e)
+        return _PIPER_VOICE
+
+# libespeak-ng loaded once per run (no process spawn + voice load per line);
+# None until first use, False if unavailable, else (lib, sample_rate)
+_ESPEAK = None
+_ESPEAK_LOCK = threading.Lock()
+_ESPEAK_PCM = []
+@ctypes.CFUNCTYPE(ctypes.c_int, ctypes.POINTER(ctypes.c_short), ctypes.c_int, ctypes.c_void_p)
+def _espeak_cb(wav, n, events):
+    if wav and n>0: _ESPEAK_PCM.append(ctypes.string_at(wav, n*2))
+    return 0
+def get_espeak():
+    global _ESPEAK
+    if _ESPEAK is None:
+        _ESPEAK = False
+        try:
+            lib = ctypes.CDLL(ctypes.util.find_library("espeak-ng") or "libespeak-ng.so.1")
+            lib.espeak_Synth.argtypes = [ctypes.c_char_p, ctypes.c_size_t, ctypes.c_uint, ctypes.c_int,
+                                         ctypes.c_uint, ctypes.c_uint, ctypes.c_void_p, ctypes.c_void_p]
+            rate = lib.espeak_Initialize(2, 0, None, 0)  # AUDIO_OUTPUT_SYNCHRONOUS
+            if rate>0:
+                lib.espeak_SetSynthCallback(_espeak_cb)
+                if lib.espeak_SetVoiceByName(b"de+f3")==0: _ESPEAK = (lib, rate)
+        except Exception as e:
+            log("libespeak-ng unavailable:", e)
+    return _ESPEAK
+
+def espeak_synth(text, out_wav):
+    with _ESPEAK_LOCK:
+        es = get_espeak()
+        if not es: return None
+        lib, rate = es
+        del _ESPEAK_PCM[:]
+        data = text.encode("utf-8")
+        # POS_CHARACTER=1, espeakCHARS_UTF8=1; returns once synthesis is done
+        if lib.espeak_Synth(data, len(data)+1, 0, 1, 0, 1, None, None)!=0 or not _ESPEAK_PCM: return None
+        with wave.open(out_wav, "wb") as w:
+            w.setnchannels(1); w.setsampwidth(2); w.setframerate(rate)
+            w.writeframes(b"".join(_ESPEAK_PCM))
+    return out_wav if file_ok(out_wav) else None
+
+# TTS engine ids: part of the voice cache key, so a file is filed under what really made it
+ESPEAK_ID = "espeak-ng:de+f3"
+def piper_id(model): return "piper:" + (os.path.basename(model) if model else "default")
+
 def synthesize_tts(text, out_wav):
+    # (wav, engine id) or (None, None)
     text = sanitize(text)
+    voice = get_piper_voice()
+    if voice:
+        try:
+            # ONNX inference already uses all cores; serialize to avoid oversubscription
+            with _PIPER_LOCK, wave.open(out_wav, "wb") as w:
+                if hasattr(voice, "synthesize_wav"): voice.synthesize_wav(text, w)
+                else: voice.synthesize(text, w)
+            if file_ok(out_wav): return out_wav, piper_id(find_piper_model())
+        except Exception as e:
+            log("Piper voice error:", e)
     piper = find_piper()
     if piper:
-        # if a model dir exists, try to use it
-        model_dir = None
-        for d in PIPER_MODEL_DIRS:
-            if os.path.isdir(d):
-                model_dir = d; break
+        # if a voice model exists, try to use it
+        model = find_piper_model()
         try:
-            if model_dir:
-                cp = subprocess.run([piper,"--model",model_dir,"--text",text,"--out",out_wav], capture_output=True, text=True)
-            else:
-                cp = subprocess.run([piper,"--text",text,"--out",out_wav], capture_output=True, text=True)
-            if cp.returncode==0 and file_ok(out_wav): return out_wav
+            cmd = [piper,"--model",model] if model else [piper]
+            if run_quiet(cmd+["--text",text,"--out",out_wav], "Piper TTS")==0 and file_ok(out_wav): return out_wav, piper_id(model)
         except Exception as e:
             log("Piper TTS error:", e)
-    # espeak-ng fallback
+    # espeak-ng fallback: shared library first, CLI if it is missing
+    if espeak_synth(text, out_wav): return out_wav, ESPEAK_ID
     try:
-        cp = subprocess.run(["espeak-ng","-v","de+f3","-w",out_wav,text], capture_output=True, text=True)
-        if cp.returncode==0 and file_ok(out_wav): return out_wav
+        if run_quiet(["espeak-ng","-v","de+f3","-w",out_wav,text], "espeak")==0 and file_ok(out_wav): return out_wav, ESPEAK_ID
     except Exception as e:
         log("espeak error:", e)
-    return None
+    return None, None
+
+def piper_pcm(voice, text):
+    # raw 16-bit mono chunks; the streaming API differs between piper-tts releases
+    if hasattr(voice, "synthesize_stream_raw"):
+        yield from voice.synthesize_stream_raw(text)
+    else:
+        for chunk in voice.synthesize(text):
+            yield chunk.audio_int16_bytes
+
+def stream_voices(voice, texts, starts, rate, fifo):
+    # one continuous voice track: silence up to each question's start, then its speech
+    try:
+        with open(fifo, "wb") as f:
+            # grow the pipe from 64 KiB so the writer isn't woken for every ffmpeg read (Linux)
+            try:
+                import fcntl
+                fcntl.fcntl(f, getattr(fcntl, "F_SETPIPE_SZ", 1031), 1<<20)
+            except (ImportError, OSError):
+                pass
+            pos = 0  # samples written
+            for text, start in zip(texts, starts):
+                gap = int(start*rate) - pos
+                if gap > 0:
+                    f.write(bytes(2*gap)); pos += gap
+                with _PIPER_LOCK:
+                    for chunk in piper_pcm(voice, text):
+                        f.write(chunk); pos += len(chunk)//2
+    except Exception as e:
+        log("Voice stream failed:", e)
+
+def piper_batch(texts, outs):
+    # piper CLI: all lines through one process (one model load) via --json-input
+    piper, model = find_piper(), find_piper_model()
+    if not (piper and model): return
+    lines = "".join(json.dumps({"text": sanitize(t), "output_file": o}) + "\n" for t,o in zip(texts, outs))
+    try:
+        run_quiet([piper,"--model",model,"--json-input"], "Piper batch", input=lines.encode("utf-8"))
+    except Exception as e:
+        log("Piper batch error:", e)
+
+def synthesize_all(questions):
+    texts = [q.get("question","") for q in questions]
+    outs = [work_path(f"q{i}.wav") for i in range(1, len(questions)+1)]
+    # a voice only depends on its text and the engine: reuse it across runs. Look up only
+    # the engine we'd use now, so an espeak fallback never stands in for a Piper voice
+    tts_key = lambda engine, t: cache_path("tts", f"{engine}|{sanitize(t)}", ".wav")
+    engine = piper_id(find_piper_model()) if (get_piper_voice() or find_piper()) else ESPEAK_ID
+    for t,o in zip(texts, outs):
+        c = tts_key(engine, t)
+        if cache_get(c): shutil.copyfile(c, o)
+    todo = [i for i,o in enumerate(outs) if not file_ok(o)]
+    made = {}  # index -> engine that produced it
+    if todo and not get_piper_voice():
+        piper_batch([texts[i] for i in todo], [outs[i] for i in todo])
+        made = {i: piper_id(find_piper_model()) for i in todo if file_ok(outs[i])}
+    # anything still missing: per-line fallback chain; independent, so overlap them
+    missing = [i for i in todo if i not in made]
+    if missing:
+        workers = max(1, min(4, os.cpu_count() or 1, len(missing)))
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            for i,(w,e) in zip(missing, ex.map(lambda i: synthesize_tts(texts[i], outs[i]), missing)):
+                if w: made[i] = e
+    for i in todo:
+        if i in made: cache_store(outs[i], tts_key(made[i], texts[i]))
+        else: outs[i] = None
+    return outs
+
+def piper_arrays(voice, texts):
+    # s16 mono PCM -> float stereo frames as AudioArrayClip wants them; None on failure
+    out = []
+    for text in texts:
+        try:
+            with _PIPER_LOCK: pcm = b"".join(piper_pcm(voice, sanitize(text)))
+            a = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+            out.append(np.repeat(a[:,None], 2, axis=1) if a.size else None)
+        except Exception as e:
+            log("Piper voice error:", e); out.append(None)
+    return out
+
+# Text layout shared by both pipelines
+@lru_cache(maxsize=8)
+def load_font(size): return ImageFont.truetype(FONT, size)
+def wrap_text(text, fontsize):
+    # greedy wrap to 90% width, like TextClip's caption mode. An options block breaks only
+    # between whole "X: ..." items (keeping OPT_SEP); a single item or plain text that is
+    # still too wide is broken between words
+    if PIL_OK and os.path.exists(FONT): measure = load_font(fontsize).getlength
+    else: measure = lambda t: len(t)*fontsize*0.62  # ~DejaVu Sans Bold advance
+    def pack(items, sep):
+        lines, cur = [], ""
+        for w in items:
+            t = f"{cur}{sep}{w}" if cur else w
+            if cur and measure(t) > WIDTH*0.9:
+                lines.append(cur); cur = w
+            else:
+                cur = t
+        return lines + [cur] if cur else lines
+    lines = []
+    for line in pack([i.strip() for i in sanitize(text).split(OPT_SEP) if i.strip()], OPT_SEP):
+        lines += pack(line.split(), " ") if measure(line) > WIDTH*0.9 else [line]
+    return lines
+
+# Pillow text frames for MoviePy
+def text_frame(bg_img, text, fontsize, y=None):
+    # wrapped lines centered horizontally; y=None centers the block vertically
+    im = bg_img.copy()
+    d = ImageDraw.Draw(im)
+    font = load_font(fontsize)
+    txt = "\n".join(wrap_text(text, fontsize))
+    x0,y0,x1,y1 = d.multiline_textbbox((0,0), txt, font=font, align="center")
+    top = (HEIGHT-(y1-y0))//2 if y is None else int(y)
+    d.multiline_text(((WIDTH-(x1-x0))//2 - x0, top - y0), txt, font=font, fill="white", align="center")
+    return np.asarray(im)
 
 # MoviePy advanced build
 def build_with_moviepy(questions):
@@ -209,52 +557,66 @@ def build_with_moviepy(questions):
         return None
     log("Building animated video via MoviePy...")
     clips=[]
-    # base background image clip
-    bg = ImageClip(BG_GEN).set_duration(0.1)
+    # voices are synthesized in the background while the scenes are drawn
+    # (in-process Piper hands PCM straight to AudioArrayClip, no WAV round-trip)
+    voice = get_piper_voice()
+    tts_pool = ThreadPoolExecutor(max_workers=1)
+    if voice:
+        f_wavs = tts_pool.submit(piper_arrays, voice, [q.get("question","") for q in questions])
+    else:
+        f_wavs = tts_pool.submit(synthesize_all, questions)
+    tts_pool.shutdown(wait=False)
+    # text is drawn by Pillow straight onto the background frame (no ImageMagick
+    # TextClip + compositing per scene); TextClip only if Pillow/the font is missing
+    pil_text = PIL_OK and os.path.exists(FONT)
+    if pil_text:
+        bg_img = Image.open(work_path(BG_GEN)).convert("RGB")
+    else:
+        bg = ImageClip(work_path(BG_GEN))
+    def scene(text, fontsize, dur, y=None):
+        if pil_text:
+            return ImageClip(text_frame(bg_img, text, fontsize, y)).set_duration(dur).set_fps(FPS)
+        txt = TextClip(text, fontsize=fontsize, font="DejaVu-Sans-Bold" if os.path.exists(FONT) else None, color="white", size=(int(WIDTH*0.9),None), method="caption").set_duration(dur)
+        return CompositeVideoClip([bg.set_duration(dur), txt.set_position(("center", "center" if y is None else y))], size=(WIDTH,HEIGHT)).set_fps(FPS)
     # intro
-    intro_txt = TextClip("Teste dein Wissen!", fontsize=76, font="DejaVu-Sans-Bold" if os.path.exists(FONT) else None, color="white", size=(int(WIDTH*0.9),None), method="caption").set_duration(INTRO_DUR)
-    intro_bg = ImageClip(BG_GEN).set_duration(INTRO_DUR)
-    intro = CompositeVideoClip([intro_bg, intro_txt.set_position(("center","center"))], size=(WIDTH,HEIGHT)).set_fps(FPS)
-    clips.append(intro)
+    clips.append(scene("Teste dein Wissen!", 76, INTRO_DUR))
     # per question
-    for idx,q in enumerate(questions, start=1):
-        # quick numeric countdown (3) — compact
-        cd = TextClip("3", fontsize=220, color="white", font="DejaVu-Sans-Bold" if os.path.exists(FONT) else None).set_duration(COUNT_DUR)
-        cd_clip = CompositeVideoClip([ImageClip(BG_GEN).set_duration(COUNT_DUR), cd.set_position("center")], size=(WIDTH,HEIGHT)).set_fps(FPS)
+    # quick numeric countdown (3) — compact; identical for every question, so build it once
+    cd_clip = scene("3", 220, COUNT_DUR)
+    q_pos = []  # index of each question scene in clips, for the TTS below
+    for q in questions:
         clips.append(cd_clip)
-        # question with TTS
-        qtext = q.get("question","Frage")
-        qdur = QUESTION_VIS
-        qtxt = TextClip(qtext, fontsize=56, color="white", size=(int(WIDTH*0.9),None), method="caption").set_duration(qdur)
-        qbg = ImageClip(BG_GEN).set_duration(qdur)
-        q_clip = CompositeVideoClip([qbg, qtxt.set_position(("center", HEIGHT*0.28))], size=(WIDTH,HEIGHT)).set_fps(FPS)
-        # tts
-        wav = f"q{idx}.wav"
-        tts = synthesize_tts(qtext, wav)
-        if tts and file_ok(tts):
-            try:
-                aud = AudioFileClip(tts)
-                q_clip = q_clip.set_audio(aud.set_start(0.05))
-            except Exception as e:
-                log("Load TTS failed:", e)
-        clips.append(q_clip)
+        # question (TTS attached once all scenes are built)
+        q_pos.append(len(clips))
+        clips.append(scene(q.get("question","Frage"), 56, QUESTION_VIS, HEIGHT*0.28))
         # answers block
         opts = q.get("options",[])
-        opts_txt = "   ".join([f"{chr(65+i)}: {o}" for i,o in enumerate(opts[:4])])
-        ans_dur = ANS_EASY if q.get("difficulty","easy")=="easy" else (ANS_MED if q.get("difficulty")=="medium" else ANS_HARD)
-        ans_txt = TextClip(opts_txt, fontsize=44, color="white", size=(int(WIDTH*0.9),None), method="caption").set_duration(ans_dur)
-        ans_bg = ImageClip(BG_GEN).set_duration(ans_dur)
-        ans_clip = CompositeVideoClip([ans_bg, ans_txt.set_position(("center", HEIGHT*0.55))], size=(WIDTH,HEIGHT)).set_fps(FPS)
-        clips.append(ans_clip)
+        opts_txt = format_options(opts)
+        ans_dur = ANS_BY_DIFFICULTY.get(q.get("difficulty","easy"), ANS_HARD)
+        clips.append(scene(opts_txt, 44, ans_dur, HEIGHT*0.55))
         # reveal
         correct = int(q.get("correct",0))
         corr_text = (opts[correct] if opts and len(opts)>correct else "Lösung")
-        rev_txt = TextClip(f"Richtige Antwort: {chr(65+correct)} — {corr_text}", fontsize=60, color="white", size=(int(WIDTH*0.9),None), method="caption").set_duration(REVEAL_DUR)
-        rev_bg = ImageClip(BG_GEN).set_duration(REVEAL_DUR)
-        rev_clip = CompositeVideoClip([rev_bg, rev_txt.set_position(("center", HEIGHT*0.45))], size=(WIDTH,HEIGHT)).set_fps(FPS)
-        clips.append(rev_clip)
+        clips.append(scene(f"Richtige Antwort: {chr(65+correct)} — {corr_text}", 60, REVEAL_DUR, HEIGHT*0.45))
+    # tts
+    voices = f_wavs.result()
+    if voice:
+        # lines in-process Piper failed on go through the cached per-line chain to WAVs
+        # (synthesize_all -> synthesize_tts: Piper CLI, libespeak-ng, espeak-ng CLI)
+        bad = [i for i,a in enumerate(voices) if a is None]
+        for i,w in zip(bad, synthesize_all([questions[i] for i in bad]) if bad else []):
+            voices[i] = w
+    for pos,tts in zip(q_pos, voices):
+        if tts is not None and (isinstance(tts, np.ndarray) or file_ok(tts)):
+            try:
+                aud = AudioArrayClip(tts, fps=voice.config.sample_rate) if isinstance(tts, np.ndarray) else AudioFileClip(tts)
+                clips[pos] = clips[pos].set_audio(aud.set_start(0.05))
+            except Exception as e:
+                log("Load TTS failed:", e)
     # concat
-    final = concatenate_videoclips(clips, method="compose")
+    # every scene is full-frame, so plain chaining is enough (compose re-blits each frame)
+    same = all(tuple(c.size)==(WIDTH,HEIGHT) for c in clips)
+    final = concatenate_videoclips(clips, method="chain" if same else "compose")
     # attach music if present
     if file_ok(MUSIC):
         try:
@@ -271,97 +633,154 @@ def build_with_moviepy(questions):
             log("Attach music failed:", e)
     # write out
     out = os.path.join(os.getcwd(), f"quiz_{datetime.now().strftime('%Y%m%d_%H%M%S')}.mp4")
-    try:
-        final.write_videofile(out, codec="libx264", audio_codec="aac", fps=FPS, threads=2, preset="medium", ffmpeg_params=["-pix_fmt","yuv420p"])
-        return out
-    except Exception as e:
-        log("MoviePy render failed:", e)
-        return None
+    # same encoder pick as the ffmpeg path. MoviePy can't insert the hwupload step and
+    # always emits -preset, which AMF/VideoToolbox reject: those go straight to libx264
+    vc = pick_vcodec()
+    if vc in VCODEC_HW or vc in ("h264_amf", "h264_videotoolbox"): vc = "libx264"
+    for c in dict.fromkeys([vc, "libx264"]):  # a failed hardware encode is retried in software
+        args = VCODEC_ARGS[c]
+        preset = args[args.index("-preset")+1] if "-preset" in args else "veryfast"
+        # -preset/-threads are passed by write_videofile itself: don't repeat them
+        params, it = [], iter(args)
+        for a in it:
+            if a in ("-preset", "-threads"): next(it)
+            else: params.append(a)
+        try:
+            final.write_videofile(out, codec=c, audio_codec="aac", temp_audiofile=work_path("moviepy_audio.m4a"), audio_fps=22050, audio_bitrate="96k", logger=None, fps=FPS, threads=os.cpu_count(), preset=preset, ffmpeg_params=params+["-pix_fmt","yuv420p","-movflags","+faststart"])
+            return out
+        except Exception as e:
+            log(f"MoviePy render ({c}) failed:", e)
+    return None
 
-# Fallback simple FFmpeg pipeline (less animated but robust)
-def fallback_pipeline(questions):
-    log("Using fallback FFmpeg pipeline...")
-    parts=[]
-    # intro
-    subprocess.run(["ffmpeg","-y","-loop","1","-i",BG_GEN,"-t",str(INTRO_DUR),"-vf",f"scale={WIDTH}:{HEIGHT}","-c:v","libx264","-pix_fmt","yuv420p","intro.mp4"])
-    parts.append("intro.mp4")
-    for i,q in enumerate(questions, start=1):
-        # countdown frame (create one big 3 image)
-        subprocess.run(["ffmpeg","-y","-loop","1","-i",BG_GEN,"-t",str(COUNT_DUR),"-vf",f"drawtext=fontfile={FONT}:text='3':fontsize=240:fontcolor=white:x=(w-text_w)/2:y=(h-text_h)/2","-c:v","libx264","-pix_fmt","yuv420p",f"q{i}_count.mp4"])
-        parts.append(f"q{i}_count.mp4")
-        qtext = q.get("question","Frage").replace(":", "\\:")
-        subprocess.run(["ffmpeg","-y","-loop","1","-i",BG_GEN,"-t",str(QUESTION_VIS),"-vf",f"drawtext=fontfile={FONT}:text='{qtext}':fontsize=56:fontcolor=white:x=(w-text_w)/2:y=h*0.28","-c:v","libx264","-pix_fmt","yuv420p",f"q{i}_q.mp4"])
-        parts.append(f"q{i}_q.mp4")
+# FFmpeg pipeline: one ffmpeg call renders, concatenates and muxes all segments;
+# no Python per-frame work, so it is the default (MoviePy only if it fails)
+def build_with_ffmpeg(questions):
+    log("Building video via FFmpeg filter graph...")
+    # segments as (text, duration, fontsize, y-expression); intro is plain background
+    count_seg = ("3", COUNT_DUR, 240, "(h-text_h)/2")
+    segs = [(None, INTRO_DUR, 0, None)]
+    q_starts = []  # timeline position of each question's voice
+    for q in questions:
+        segs.append(count_seg)
+        q_starts.append(sum(d for _,d,_,_ in segs) + 0.05)
+        segs.append((q.get("question","Frage"), QUESTION_VIS, 56, "h*0.28"))
         opts = q.get("options",[])
-        opts_txt = "   ".join([f"{chr(65+idx)}: {o}" for idx,o in enumerate(opts[:4])]).replace(":", "\\:")
-        dur = ANS_EASY if q.get("difficulty","easy")=="easy" else (ANS_MED if q.get("difficulty")=="medium" else ANS_HARD)
-        subprocess.run(["ffmpeg","-y","-loop","1","-i",BG_GEN,"-t",str(dur),"-vf",f"drawtext=fontfile={FONT}:text='{opts_txt}':fontsize=44:fontcolor=white:x=(w-text_w)/2:y=h*0.55","-c:v","libx264","-pix_fmt","yuv420p",f"q{i}_a.mp4"])
-        parts.append(f"q{i}_a.mp4")
+        opts_txt = format_options(opts)
+        dur = ANS_BY_DIFFICULTY.get(q.get("difficulty","easy"), ANS_HARD)
+        segs.append((opts_txt, dur, 44, "h*0.55"))
         corr = int(q.get("correct",0))
         corr_txt = opts[corr] if len(opts)>corr else "Lösung"
-        subprocess.run(["ffmpeg","-y","-loop","1","-i",BG_GEN,"-t",str(REVEAL_DUR),"-vf",f"drawtext=fontfile={FONT}:text='Richtige Antwort: {corr_txt}':fontsize=56:fontcolor=white:x=(w-text_w)/2:y=h*0.45","-c:v","libx264","-pix_fmt","yuv420p",f"q{i}_rev.mp4"])
-        parts.append(f"q{i}_rev.mp4")
-        # tts
-        wav = f"q{i}.wav"
-        synthesize_tts(q.get("question",""), wav)
-    # concat
-    with open("concat_list.txt","w",encoding="utf-8") as f:
-        for p in parts: f.write(f"file '{p}'\n")
-    cp = subprocess.run(["ffmpeg","-y","-f","concat","-safe","0","-i","concat_list.txt","-c","copy","merged.mp4"], capture_output=True, text=True)
-    if cp.returncode != 0:
-        log("Concat failed:", cp.stderr)
-        return None
-    # mix voices and music properly (voices amix then music)
-    voice_files = [f"q{i}.wav" for i in range(1, len(questions)+1) if file_ok(f"q{i}.wav")]
-    inputs = ["-i","merged.mp4"]
-    for v in voice_files: inputs += ["-i", v]
-    if file_ok(MUSIC): inputs += ["-i", MUSIC]
-    num_voice = len(voice_files)
+        segs.append((f"Richtige Antwort: {chr(65+corr)} — {corr_txt}", REVEAL_DUR, 56, "h*0.45"))
+    # video graph: the background is decoded once (single frame) and split into one branch
+    # per segment; each branch gets its text drawn once, is repeated to its duration with
+    # loop (refs of one buffer), then all are concatenated. Identical segments (the
+    # countdown, a repeated reveal) are rendered once and split again
+    inputs = FFPROBE_FAST + ["-i", work_path(BG_GEN)]
+    chains, labels = [], []
+    uses = {}
+    for seg in segs: uses[seg] = uses.get(seg, 0) + 1
+    shared = {}  # seg -> [branch, next free split output]
+    nb = 0
+    for seg in segs:
+        if seg in shared:
+            b, k = shared[seg]
+            labels.append(f"[v{b}_{k}]"); shared[seg][1] += 1
+            continue
+        text,dur,fs,y = seg
+        chain = f"[b{nb}]"
+        # drawtext doesn't wrap: one centered drawtext per wrapped line, all on the same frame
+        for i,line in enumerate(wrap_text(text, fs) if text else []):
+            chain += f"drawtext=fontfile={FONT}:expansion=none:text={ff_text(line)}:fontsize={fs}:fontcolor=white:x=(w-text_w)/2:y={y}+{round(i*fs*1.25)},"
+        chain += f"loop=loop={max(1, round(dur*FPS))-1}:size=1,setpts=N/({FPS}*TB)"
+        if uses[seg]>1:
+            chain += f",split={uses[seg]}" + "".join(f"[v{nb}_{j}]" for j in range(uses[seg]))
+            labels.append(f"[v{nb}_0]"); shared[seg] = [nb, 1]
+        else:
+            chain += f"[v{nb}]"; labels.append(f"[v{nb}]")
+        chains.append(chain)
+        nb += 1
+    chains.insert(0, f"[0:v]scale={WIDTH}:{HEIGHT},setsar=1,settb=1/{FPS},split={nb}" + "".join(f"[b{i}]" for i in range(nb)))
+    fc = ";".join(chains) + ";" + "".join(labels) + f"concat=n={len(labels)}:v=1:a=0,{vcodec_format()}[vout]"
+    nvid = 1
+    # voices: with in-process Piper, stream PCM through a FIFO so TTS runs while
+    # ffmpeg encodes; otherwise synthesize WAVs first
+    voice = get_piper_voice() if hasattr(os, "mkfifo") else None
+    if voice:
+        fifo = work_path("voices.pcm")
+        os.mkfifo(fifo)
+        rate = voice.config.sample_rate
+        texts = [sanitize(q.get("question","")) for q in questions]
+        writer = threading.Thread(target=stream_voices, args=(voice, texts, q_starts, rate, fifo), daemon=True)
+        writer.start()
+        inputs += ["-f","s16le","-ar",str(rate),"-ac","1","-i",fifo]
+        delays = [0]  # stream is already padded to each question's start
+    else:
+        wavs = synthesize_all(questions)
+        delays = []
+        for w,t in zip(wavs, q_starts):
+            if w and file_ok(w):
+                inputs += ["-i", w]; delays.append(int(t*1000))
+    num_voice = len(delays)
     has_music = file_ok(MUSIC)
+    # loop a short track / cut a long one to the video length at demux time, so the
+    # output doesn't run past the last segment and no audio gets decoded for nothing
+    if has_music: inputs += ["-stream_loop","-1","-t",f"{sum(d for _,d,_,_ in segs):.3f}","-i",MUSIC]
+    # place each WAV at its question segment on the timeline
+    fc += "".join(f";[{nvid+i}:a]adelay={d}:all=1[d{i}]" for i,d in enumerate(delays) if d)
+    voice_labels = "".join(f"[d{i}]" if d else f"[{nvid+i}:a]" for i,d in enumerate(delays))
     if num_voice>0 and has_music:
-        voice_labels = "".join([f"[{i+1}:a]" for i in range(num_voice)])
-        music_idx = num_voice+1
-        fc = f"{voice_labels}amix=inputs={num_voice}:duration=longest[vvoices];[{music_idx}:a]volume=0.18[vmusic];[vvoices][vmusic]amix=inputs=2:duration=longest[aout]"
+        music_idx = nvid+num_voice
+        fc += f";{voice_labels}amix=inputs={num_voice}:duration=longest[vvoices];[{music_idx}:a]volume=0.18[vmusic];[vvoices][vmusic]amix=inputs=2:duration=longest[aout]"
     elif num_voice>0:
-        voice_labels = "".join([f"[{i+1}:a]" for i in range(num_voice)])
-        fc = f"{voice_labels}amix=inputs={num_voice}:duration=longest[aout]"
+        fc += f";{voice_labels}amix=inputs={num_voice}:duration=longest[aout]"
     elif has_music:
-        fc = "[1:a]volume=0.18[aout]"
-    else:
-        fc = ""
-    cmd = ["ffmpeg","-y"] + inputs
-    if fc:
-        cmd += ["-filter_complex", fc, "-map","0:v","-map","[aout]","-c:v","libx264","-pix_fmt","yuv420p","-c:a","aac","-b:a","192k","final.mp4"]
-    else:
-        cmd += ["-map","0:v","-c:v","libx264","-pix_fmt","yuv420p","final.mp4"]
-    cp = subprocess.run(cmd, capture_output=True, text=True)
-    if cp.returncode != 0:
-        log("Final ffmpeg failed:", cp.stderr)
-        return None
+        fc += f";[{nvid}:a]volume=0.18[aout]"
     final_name = os.path.join(os.getcwd(), f"quiz_{datetime.now().strftime('%Y%m%d_%H%M%S')}.mp4")
-    shutil.move("final.mp4", final_name)
+    cmd = ["ffmpeg","-y"] + vcodec_device() + inputs + ["-filter_complex", fc, "-map","[vout]"]
+    if num_voice>0 or has_music:
+        cmd += ["-map","[aout]","-c:a","aac","-b:a","192k"]
+    cmd += vcodec_args() + ["-r",str(FPS),"-movflags","+faststart",final_name]
+    rc = run_quiet(cmd, "Final ffmpeg")
+    if voice:
+        # if ffmpeg died before opening the FIFO, unblock the writer
+        try: os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+        except OSError: pass
+        writer.join(timeout=5)
+    if rc != 0:
+        return None
     return final_name
 
 # Main
 def main():
     log("Start quiz video generation...")
-    if not ensure_background():
+    topic = "Allgemeinwissen"
+    # background, encoder probe and TTS model load don't depend on the questions;
+    # run them while the (network/LLM bound) question generation is in flight
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        f_bg = ex.submit(ensure_background)
+        ex.submit(pick_vcodec)
+        ex.submit(get_piper_voice)
+        questions = generate_questions(topic, NUM_QUESTIONS)
+        bg_ok = f_bg.result()
+    if not bg_ok:
         log("Background creation failed.")
         sys.exit(1)
-    topic = "Allgemeinwissen"
-    questions = generate_questions(topic, NUM_QUESTIONS)
     if not questions or len(questions) < NUM_QUESTIONS:
         log("Question generation failed; abort.")
         sys.exit(1)
-    out = None
+    # ffmpeg graph first; MoviePy only as fallback unless USE_MOVIEPY=1 asks for it
+    builders = [build_with_ffmpeg]
     if MOVIEPY:
+        if os.environ.get("USE_MOVIEPY") == "1": builders.insert(0, build_with_moviepy)
+        else: builders.append(build_with_moviepy)
+    out = None
+    for build in builders:
         try:
-            out = build_with_moviepy(questions)
+            out = build(questions)
         except Exception as e:
-            log("MoviePy pipeline error:", e)
+            log(f"{build.__name__} error:", e)
             out = None
-    if not out:
-        out = fallback_pipeline(questions)
+        if out: break
     if not out or not file_ok(out):
         log("Failed to produce video.")
         sys.exit(1)